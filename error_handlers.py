@@ -1,10 +1,20 @@
 """
 Error handling utilities for the PDF OCR tool
 """
+import functools
 import os
+import shutil
+import stat
 import sys
 from pathlib import Path
 
+# check for PyMuPDF once when this module loads
+try:
+    import fitz as _fitz
+    _HAS_PYMUPDF = True
+except ImportError:
+    _HAS_PYMUPDF = False
+
 
 class PdfOcrError(Exception):
     """Base exception class for PDF OCR tool"""
@@ -26,6 +36,19 @@ class OutputError(PdfOcrError):
     pass
 
 
+@functools.lru_cache(maxsize=1)
+def find_tesseract():
+    """
+    Locate the tesseract executable on PATH
+
+    The PATH scan only happens once per process, later calls reuse the result.
+
+    Returns:
+        Full path to tesseract, or None if it is not installed
+    """
+    return shutil.which("tesseract")
+
+
 def verify_tesseract_installed():
     """
     Check if Tesseract is installed and accessible
@@ -33,9 +56,7 @@ def verify_tesseract_installed():
     Raises:
         TesseractError: If Tesseract is not installed or not accessible
     """
-    import shutil
-
-    if not shutil.which("tesseract"):
+    if not find_tesseract():
         msg = (
             "Tesseract OCR not found. Please install Tesseract:\n"
             "  - Windows: https://github.com/UB-Mannheim/tesseract/wiki\n"
@@ -52,9 +73,7 @@ def verify_pymupdf_installed():
     Raises:
         PdfOcrError: If PyMuPDF is not installed
     """
-    try:
-        import fitz
-    except ImportError:
+    if not _HAS_PYMUPDF:
         msg = (
             "PyMuPDF not found. Please install it:\n"
             "  pip install PyMuPDF\n"
@@ -70,20 +89,28 @@ def verify_input_file(file_path):
     Args:
         file_path: Path to the input file
         
+    Returns:
+        The os.stat_result for the file, so callers don't need to stat it again
+        
     Raises:
         InputFileError: If the file doesn't exist or is not a PDF
     """
-    path = Path(file_path)
-    
-    if not path.exists():
+    # one stat call tells us both whether it exists and what it is
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
         raise InputFileError(f"Input file not found: {file_path}")
+    except OSError as e:
+        raise InputFileError(f"Cannot access input file: {e}")
         
-    if not path.is_file():
+    if not stat.S_ISREG(st.st_mode):
         raise InputFileError(f"Input path is not a file: {file_path}")
         
-    if path.suffix.lower() != ".pdf":
+    if not os.fspath(file_path).lower().endswith(".pdf"):
         raise InputFileError(f"Input file is not a PDF: {file_path}")
 
+    return st
+
 
 def verify_output_location(output_path, is_directory=False):
     """
@@ -98,24 +125,29 @@ def verify_output_location(output_path, is_directory=False):
     """
     path = Path(output_path)
     
-    # Check if parent directory exists
-    if not path.parent.exists():
-        try:
-            os.makedirs(path.parent, exist_ok=True)
-        except OSError as e:
-            raise OutputError(f"Cannot create output directory: {e}")
+    # one stat call tells us both whether it exists and what it is
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        st = None
+    except OSError as e:
+        raise OutputError(f"Cannot access output location: {e}")
             
+    # Nothing there yet - create the directory (or the one the file goes in,
+    # unless it's already there - usually it is)
+    if st is None:
+        if is_directory or not os.path.isdir(path.parent):
+            try:
+                os.makedirs(path if is_directory else path.parent, exist_ok=True)
+            except OSError as e:
+                raise OutputError(f"Cannot create output directory: {e}")
+    
     # If output should be a directory
-    if is_directory:
-        if path.exists() and not path.is_dir():
+    elif is_directory:
+        if not stat.S_ISDIR(st.st_mode):
             raise OutputError(f"Output path exists but is not a directory: {output_path}")
-        
-        try:
-            os.makedirs(path, exist_ok=True)
-        except OSError as e:
-            raise OutputError(f"Cannot create output directory: {e}")
     
     # If output is a file
     else:
-        if path.exists() and not path.is_file():
-            raise OutputError(f"Output path exists but is not a file: {output_path}") 
\ No newline at end of file
+        if not stat.S_ISREG(st.st_mode):
+            raise OutputError(f"Output path exists but is not a file: {output_path}")
@@ -3,6 +3,7 @@
 # Just a simple interface so you don't have to use command line
 
 import os
+import queue
 import sys
 import threading
 import tkinter as tk
@@ -11,26 +12,26 @@ from tkinter.scrolledtext import ScrolledText
 from typing import List, Optional
 
 from ocr_pdf import PdfOcr
-from error_handlers import PdfOcrError, verify_tesseract_installed, verify_pymupdf_installed
+from error_handlers import PdfOcrError
 
 
 class TextRedirector:
-    # This class captures print statements and shows them in the GUI log window
+    # This class captures print statements and sends them to the GUI log window
+    # print() gets called from the worker thread, and Tk widgets must only be touched
+    # from the main thread, so we just put the text on a queue for the main thread to pick up
 
-    def __init__(self, text_widget):
-        self.text_widget = text_widget
-        self.buffer = ""
+    def __init__(self, message_queue):
+        self.queue = message_queue
 
     def write(self, string):
-        self.buffer += string
-        self.text_widget.config(state=tk.NORMAL)
-        self.text_widget.insert(tk.END, string)
-        self.text_widget.see(tk.END)  # auto-scroll to bottom
-        self.text_widget.config(state=tk.DISABLED)
+        self.queue.put(("log", string))
 
     def flush(self):
         pass  # tkinter doesn't need this but Python expects it
 
+    def isatty(self):
+        return False  # so progress bars don't try to animate in the log window
+
 
 class PdfOcrGui:
     def __init__(self, root):
@@ -142,11 +143,11 @@ class PdfOcrGui:
         )
         self.process_btn.pack(fill=tk.X)
 
-        # spinning progress bar
+        # progress bar (pages done in the current file, or files done in a batch)
         self.progress_frame = ttk.Frame(self.main_frame)
         self.progress_frame.pack(fill=tk.X, pady=5)
 
-        self.progress_bar = ttk.Progressbar(self.progress_frame, mode="indeterminate")
+        self.progress_bar = ttk.Progressbar(self.progress_frame, mode="determinate")
         self.progress_bar.pack(fill=tk.X)
         
         # text area to show what's happening
@@ -156,13 +157,53 @@ class PdfOcrGui:
         self.log_text = ScrolledText(self.log_frame, height=10, state=tk.DISABLED)
         self.log_text.pack(fill=tk.BOTH, expand=True)
 
+        # messages from the worker thread (log text, popups) come through this queue
+        self.message_queue = queue.Queue()
+
         # capture print statements and show them in the log
-        self.stdout_redirector = TextRedirector(self.log_text)
+        self.stdout_redirector = TextRedirector(self.message_queue)
 
         # keep track of stuff
         self.input_files = []
         self.processing_thread = None
 
+        # start checking the queue for messages
+        self.root.after(50, self._drain_queue)
+
+    def _drain_queue(self):
+        # runs on the main thread every 50ms - this is the only place the log gets updated
+        text = []
+        popups = []
+        while True:
+            try:
+                message = self.message_queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if message[0] == "log":
+                text.append(message[1])
+            elif message[0] == "progress":
+                # only the latest progress matters
+                _, done, total = message
+                self.progress_bar.config(maximum=max(total, 1), value=done)
+            else:
+                popups.append(message)
+
+        # add everything that came in since last time in one go
+        if text:
+            self.log_text.config(state=tk.NORMAL)
+            self.log_text.insert(tk.END, "".join(text))
+            self.log_text.see(tk.END)  # auto-scroll to bottom
+            self.log_text.config(state=tk.DISABLED)
+
+        for kind, title, msg in popups:
+            if kind == "info":
+                messagebox.showinfo(title, msg)
+            else:
+                messagebox.showerror(title, msg)
+
+        self.root.after(50, self._drain_queue)
+
     def add_files(self):
         # open file dialog to pick PDFs
         files = filedialog.askopenfilenames(
@@ -205,8 +246,8 @@ class PdfOcrGui:
         # Disable UI during processing
         self.toggle_ui_state(False)
         
-        # Start progress bar
-        self.progress_bar.start()
+        # Reset progress bar
+        self.progress_bar.config(value=0)
         
         # Clear log
         self.log_text.config(state=tk.NORMAL)
@@ -233,26 +274,29 @@ class PdfOcrGui:
     def _process_thread(self, files, output_dir, dpi, language, optimize_size):
         """Thread function to process files"""
         try:
-            # Verify required dependencies are installed
-            verify_tesseract_installed()
-            verify_pymupdf_installed()
-
-            # Create processor
-            processor = PdfOcr(dpi=dpi, language=language, optimize_size=optimize_size)
+            # Create processor (this also checks that the OCR tools are installed)
+            processor = PdfOcr(
+                dpi=dpi,
+                language=language,
+                optimize_size=optimize_size,
+                progress_callback=self._post_progress
+            )
             
             # Process files
             processor.process_batch(files, output_dir)
             
             # Show success message
-            self.root.after(0, lambda: messagebox.showinfo("Success", "PDF OCR processing completed!"))
+            self.message_queue.put(("info", "Success", "PDF OCR processing completed!"))
             
         except PdfOcrError as e:
-            error_msg = str(e)
-            self.root.after(0, lambda msg=error_msg: messagebox.showerror("Error", msg))
+            self.message_queue.put(("error", "Error", str(e)))
         except Exception as e:
-            error_msg = str(e)
-            self.root.after(0, lambda msg=error_msg: messagebox.showerror("Unexpected Error", msg))
+            self.message_queue.put(("error", "Unexpected Error", str(e)))
     
+    def _post_progress(self, done, total):
+        # called from the worker thread, so just queue it up for the main thread
+        self.message_queue.put(("progress", done, total))
+
     def check_processing_thread(self):
         """Check if the processing thread is still running"""
         if self.processing_thread and self.processing_thread.is_alive():
@@ -261,7 +305,6 @@ class PdfOcrGui:
         else:
             # Thread finished, restore UI
             self.processing_thread = None
-            self.progress_bar.stop()
             
             # Restore stdout/stderr
             sys.stdout = self.old_stdout
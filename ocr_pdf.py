@@ -3,48 +3,604 @@
 # Basically converts images in PDFs to text that you can search/copy
 
 import argparse
+import contextlib
+import functools
+import hashlib
+import importlib.util
+import io
+import itertools
+import multiprocessing
 import os
+import shutil
+import subprocess
 import sys
 import tempfile
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from pathlib import Path
-from typing import List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple, Union
 
-import pytesseract  # does the actual OCR magic
 import fitz  # PyMuPDF - handles PDF stuff without needing poppler
 from PIL import Image
-from PyPDF2 import PdfWriter, PdfReader  # for combining pages back into PDF
 from tqdm import tqdm  # progress bars
 
 from error_handlers import (
     PdfOcrError, InputFileError, TesseractError, OutputError,
-    verify_tesseract_installed, verify_pymupdf_installed,
+    find_tesseract, verify_tesseract_installed, verify_pymupdf_installed,
     verify_input_file, verify_output_location
 )
 
 
+# the ways we can run tesseract:
+#   tesserocr - libtesseract inside this process (needs pip install tesserocr)
+#   pymupdf   - the copy of tesseract built into PyMuPDF (needs tesseract's language data)
+#   tesseract - start the tesseract program, once for every few pages
+# "auto" picks tesserocr, then the tesseract program, and pymupdf only if neither is there
+ENGINES = ("auto", "tesserocr", "pymupdf", "tesseract")
+
+# a page PDF from tesseract smaller than this has no page in it
+MIN_PDF_BYTES = 512
+
+# the tesseract program loads its language model every time it starts, so each run gets
+# up to this many pages (listed in a text file) instead of just one
+PAGES_PER_TESSERACT_RUN = 8
+
+# on long documents, write the output built so far to disk every this many pages
+FLUSH_EVERY_PAGES = 64
+
+# the OMP_THREAD_LIMIT we were started with, what tesseract gets when we don't limit it ourselves
+_inherited_thread_limit = os.environ.get("OMP_THREAD_LIMIT")
+
+# a page with more selectable text than this already has a text layer and is copied as-is
+MIN_TEXT_CHARS = 50
+
+# JPEG quality (0-1) of the OCR'd page images when optimizing, unless told otherwise
+DEFAULT_IMAGE_QUALITY = 0.75
+
+
+@functools.lru_cache(maxsize=1)
+def _find_tessdata() -> Optional[str]:
+    # PyMuPDF's OCR needs to be told where tesseract's language files are
+    if os.environ.get("TESSDATA_PREFIX"):
+        return os.environ["TESSDATA_PREFIX"]
+
+    # newer PyMuPDF versions can go looking for them
+    get_tessdata = getattr(fitz, "get_tessdata", None)
+    if get_tessdata is not None:
+        try:
+            return get_tessdata() or None
+        except Exception:
+            return None
+
+    return None
+
+
+@functools.lru_cache(maxsize=1)
+def _tesserocr_available() -> bool:
+    # optional - runs libtesseract inside this process instead of starting
+    # a tesseract program for every few pages (pip install tesserocr)
+    # this only checks that it's installed, it gets imported in _get_tesserocr_api
+    return importlib.util.find_spec("tesserocr") is not None
+
+
+def _pymupdf_ocr_available() -> bool:
+    # older PyMuPDF versions don't have OCR built in
+    return hasattr(fitz.Pixmap, "pdfocr_tobytes") and _find_tessdata() is not None
+
+
+def _pixmap_to_image(pix: fitz.Pixmap) -> Image.Image:
+    # wrap the raw pixels as a PIL image - no JPEG encode/decode needed
+    # frombuffer() can use the pixel data where it is (grayscale) instead of copying it again
+    mode = "L" if pix.n == 1 else "RGB"
+    return Image.frombuffer(mode, (pix.width, pix.height), pix.samples, "raw", mode, pix.stride, 1)
+
+
+def _ocr_page_pymupdf(page_num: int, pix: fitz.Pixmap, language: str) -> bytes:
+    # PyMuPDF runs tesseract in-process and hands back a one-page PDF
+    # (it isn't thread-safe, so this always runs on the calling thread)
+    try:
+        return pix.pdfocr_tobytes(compress=True, language=language, tessdata=_find_tessdata())
+    except Exception as e:
+        raise TesseractError(f"OCR processing failed on page {page_num + 1}: {str(e)}")
+
+
+class _OcrSettings(NamedTuple):
+    # everything tesseract needs to know, bundled up so it can be handed to worker threads
+    engine: str  # "tesserocr" or "tesseract"
+    language: str
+    psm: int  # page segmentation mode (--psm)
+    oem: int  # OCR engine mode (--oem)
+    variables: Tuple[Tuple[str, str], ...]  # the "-c name=value" options
+    version: str  # which tesseract this is (only filled in when caching, it's part of the key)
+
+
+# one page for a tesserocr worker thread:
+# (page number, page image or None if it already has text, settings, cache folder or None)
+_PageTask = Tuple[int, Optional[Image.Image], _OcrSettings, Optional[str]]
+
+# a run of pages for one tesseract program: ([(page number, PNM file or None if it already
+# has text), ...], settings, cache folder or None, OMP_THREAD_LIMIT or None, scratch folder)
+_ChunkTask = Tuple[List[Tuple[int, Optional[str]]], _OcrSettings, Optional[str], Optional[str], str]
+
+# each OCR worker thread keeps its own libtesseract instance (they can't be shared between threads)
+_thread_state = threading.local()
+
+
+def _get_tesserocr_api(settings: _OcrSettings):
+    # load the language model once per thread and reuse it for every page after that
+    if getattr(_thread_state, "settings", None) != settings:
+        # imported this late on purpose: libtesseract's OpenMP reads OMP_THREAD_LIMIT once,
+        # when the library loads, so it has to be set (see _limit_tesserocr_threads) first
+        import tesserocr
+
+        api = getattr(_thread_state, "api", None)
+        if api is not None:
+            api.End()
+
+        api = tesserocr.PyTessBaseAPI(lang=settings.language, psm=settings.psm, oem=settings.oem)
+        for name, value in settings.variables:
+            api.SetVariable(name, value)
+
+        _thread_state.api = api
+        _thread_state.settings = settings
+
+    return _thread_state.api
+
+
+def _scratch_location(size_estimate: int) -> Optional[str]:
+    # put scratch files in RAM (/dev/shm on Linux) when there's comfortably enough room,
+    # they're thrown away at the end anyway so there's no point writing them to disk
+    # None means the normal temp folder
+    if os.path.isdir("/dev/shm"):
+        try:
+            if size_estimate < 0.7 * shutil.disk_usage("/dev/shm").free:
+                return "/dev/shm"
+        except OSError:
+            pass
+    return None
+
+
+def _get_scratch_base() -> str:
+    # libtesseract's PDF renderer can only write to a file, so each thread gets a scratch
+    # folder that it reuses for every page (it's deleted when the thread goes away)
+    if getattr(_thread_state, "scratch", None) is None:
+        _thread_state.scratch = tempfile.TemporaryDirectory(dir=_scratch_location(0))
+        _thread_state.scratch_base = os.path.join(_thread_state.scratch.name, "page")
+    return _thread_state.scratch_base
+
+
+def _ocr_page_tesserocr(page_num: int, image: Image.Image, settings: _OcrSettings) -> bytes:
+    api = _get_tesserocr_api(settings)
+    output_base = _get_scratch_base()
+
+    if not api.ProcessPage(output_base, image, page_num, output_base):
+        raise TesseractError("libtesseract could not process the page")
+
+    return Path(output_base + ".pdf").read_bytes()
+
+
+def _ocr_pages_tesseract(list_path: str, settings: _OcrSettings, thread_limit: Optional[str]) -> bytes:
+    # run the tesseract program once over all the page images listed in list_path (one file
+    # per line) - the language model is loaded once for all of them, and the multi-page PDF
+    # comes back on stdout
+    command = [
+        find_tesseract(), list_path, "stdout",
+        "-l", settings.language,
+        "--oem", str(settings.oem),
+        "--psm", str(settings.psm),
+    ]
+    for name, value in settings.variables:
+        command += ["-c", f"{name}={value}"]
+    command.append("pdf")
+
+    result = subprocess.run(
+        command,
+        capture_output=True,
+        env=_tesseract_env(thread_limit),
+        # don't flash a console window for every run when running from the GUI on Windows
+        creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0)
+    )
+    if result.returncode != 0:
+        message = result.stderr.decode(errors="replace").strip()
+        raise TesseractError(f"tesseract exited with code {result.returncode}: {message}")
+
+    return result.stdout
+
+
+@functools.lru_cache(maxsize=None)
+def _engine_version(engine: str) -> str:
+    # goes into the cache key, so results from before a tesseract upgrade aren't reused
+    if engine == "tesserocr":
+        import tesserocr
+        return tesserocr.tesseract_version()
+    if engine == "pymupdf":
+        # the tesseract in PyMuPDF is built into MuPDF, so it changes with the MuPDF version
+        return f"mupdf {fitz.VersionFitz}"
+
+    # older versions print this to stderr instead of stdout
+    result = subprocess.run(
+        [find_tesseract(), "--version"],
+        capture_output=True,
+        creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0)
+    )
+    return (result.stdout + result.stderr).decode(errors="replace").strip()
+
+
+def _default_cache_dir() -> str:
+    # where OCR'd pages are remembered between runs (~/.cache/pdfocr on most systems)
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(str(Path.home()), ".cache")
+    return os.path.join(base, "pdfocr")
+
+
+def _read_cache(cache_path: str) -> Optional[bytes]:
+    try:
+        return Path(cache_path).read_bytes()
+    except OSError:
+        return None  # not cached yet
+
+
+def _write_cache(cache_path: str, page_pdf: bytes) -> None:
+    # write to a temp name first so another thread/process never reads half a file
+    temp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        Path(temp_path).write_bytes(page_pdf)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        pass  # caching is only a speed-up, never fail the page over it
+
+
+def _cached_ocr(cache_path: Optional[str], ocr: Callable[[], bytes]) -> bytes:
+    # reuse the stored result if we've OCR'd this exact page image before,
+    # otherwise do the OCR and store the result for next time
+    page_pdf = _read_cache(cache_path) if cache_path else None
+    if page_pdf is None:
+        page_pdf = ocr()
+        if cache_path:
+            _write_cache(cache_path, page_pdf)
+    return page_pdf
+
+
+def _cache_path(cache_dir: str, language: str, key: Any, data) -> str:
+    # the cache key covers the exact pixels and every setting that changes the OCR output
+    # (blake2b is fast enough that hashing a page costs next to nothing compared to OCR)
+    digest = hashlib.blake2b(repr(key).encode(), digest_size=16)
+    digest.update(data)
+    return os.path.join(cache_dir, f"{language}_{digest.hexdigest()}.pdf")
+
+
+def _ocr_page_worker(task: _PageTask) -> Optional[bytes]:
+    # OCR one rendered page with tesserocr into a one-page searchable PDF (returned as bytes)
+    # libtesseract runs outside the GIL, so running this from several threads at once
+    # really does use several cores
+    # the cache lookup happens here too, so hashing the page doesn't hold up rendering
+    # None means the page already has text and wasn't rendered, so there's nothing to do
+    page_num, image, settings, cache_dir = task
+    if image is None:
+        return None
+    try:
+        cache_path = cache_dir and _cache_path(
+            cache_dir, settings.language, (settings, image.mode, image.size), image.tobytes()
+        )
+        return _cached_ocr(cache_path, lambda: _ocr_page_tesserocr(page_num, image, settings))
+    except Exception as e:
+        raise TesseractError(f"OCR processing failed on page {page_num + 1}: {str(e)}")
+
+
+def _ocr_chunk_worker(task: _ChunkTask) -> Tuple[List[Tuple[str, Any]], Optional[bytes]]:
+    # OCR a run of pages with a single tesseract program, in a worker thread
+    # hands back what happened to each page - ("skip", None) if it already has text,
+    # ("cached", page_pdf) if the cache had it, or ("ocr", cache_path) if it's the next page
+    # of the returned multi-page PDF. Splitting that PDF up needs PyMuPDF, which has to
+    # stay on the main thread (see _split_chunks).
+    pages, settings, cache_dir, thread_limit, scratch_dir = task
+    first, last = pages[0][0] + 1, pages[-1][0] + 1
+
+    results = []
+    to_ocr = []
+    try:
+        for page_num, image_path in pages:
+            if image_path is None:
+                results.append(("skip", None))
+                continue
+
+            # the PNM data starts with the image size, so the bytes alone identify the page
+            cache_path = None
+            if cache_dir:
+                cache_path = _cache_path(cache_dir, settings.language, settings, Path(image_path).read_bytes())
+                page_pdf = _read_cache(cache_path)
+                if page_pdf is not None:
+                    results.append(("cached", page_pdf))
+                    continue
+
+            results.append(("ocr", cache_path))
+            to_ocr.append(image_path)
+
+        chunk_pdf = None
+        if to_ocr:
+            list_path = os.path.join(scratch_dir, f"pages_{first}.txt")
+            Path(list_path).write_text("\n".join(to_ocr) + "\n")
+            chunk_pdf = _ocr_pages_tesseract(list_path, settings, thread_limit)
+    except Exception as e:
+        raise TesseractError(f"OCR processing failed on pages {first}-{last}: {str(e)}")
+    finally:
+        # the page images aren't needed any more, don't let them pile up in the scratch folder
+        for _, image_path in pages:
+            if image_path is not None:
+                try:
+                    os.remove(image_path)
+                except OSError:
+                    pass
+
+    return results, chunk_pdf
+
+
+def _split_chunks(chunks: Iterable[Tuple[List[Tuple[str, Any]], Optional[bytes]]]) -> Iterator[Optional[bytes]]:
+    # turn the results of _ocr_chunk_worker back into one page PDF per page, in page order
+    # (and store the newly OCR'd pages in the cache)
+    for pages, chunk_pdf in chunks:
+        chunk_doc = fitz.open("pdf", chunk_pdf) if chunk_pdf else None
+        try:
+            expected = sum(1 for kind, _ in pages if kind == "ocr")
+            if expected and chunk_doc.page_count != expected:
+                raise TesseractError(f"tesseract returned {chunk_doc.page_count} pages instead of {expected}")
+
+            next_page = 0
+            for kind, value in pages:
+                if kind != "ocr":
+                    yield value
+                    continue
+
+                with fitz.open() as page_doc:
+                    page_doc.insert_pdf(chunk_doc, from_page=next_page, to_page=next_page)
+                    page_pdf = page_doc.tobytes()
+                next_page += 1
+
+                if value:
+                    _write_cache(value, page_pdf)
+                yield page_pdf
+        finally:
+            if chunk_doc is not None:
+                chunk_doc.close()
+
+
+def _map_bounded(executor: Executor, func: Callable, items: Iterable, limit: int) -> Iterator[Any]:
+    # like executor.map(), but only keeps `limit` tasks in flight at once
+    # executor.map() pulls every item up front, which for us means rendering
+    # every page of the PDF into memory before the first one is even OCR'd
+    pending = deque()
+    for item in items:
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+
+    # results still come back in the order the items went in
+    while pending:
+        yield pending.popleft().result()
+
+
+def _as_completed_bounded(executor: Executor, func: Callable, items: Iterable[Tuple[Any, tuple]],
+                          limit: int) -> Iterator[Tuple[Any, Any]]:
+    # like submitting everything and looping over as_completed(), but only keeps `limit`
+    # tasks queued at once - a batch of thousands of files doesn't need thousands of futures
+    # items are (tag, args) pairs, and (tag, result) pairs come back as tasks finish
+    items = iter(items)
+    pending = {}
+    while True:
+        for tag, args in itertools.islice(items, limit - len(pending)):
+            pending[executor.submit(func, *args)] = tag
+        if not pending:
+            return
+
+        finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in finished:
+            yield pending.pop(future), future.result()
+
+
+def _ocr_in_threads(func: Callable, tasks: Iterable, workers: int) -> Iterator[Any]:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # pages are rendered as workers free up, so only a few page images are in memory at once
+        yield from _map_bounded(executor, func, tasks, limit=workers * 2)
+
+
+def _thread_limit(workers: int, omp_threads: Optional[int] = None) -> Optional[str]:
+    # tesseract uses several OpenMP threads per page by default - when we're already running
+    # one tesseract per core that just makes them fight over the CPU, so cap each one at a
+    # single thread. An OMP_THREAD_LIMIT the user set themselves is left alone, unless
+    # omp_threads asks for a specific number. None = no limit of our own.
+    if omp_threads:
+        return str(omp_threads)
+    if workers > 1:
+        return _inherited_thread_limit or "1"
+    return None
+
+
+def _tesseract_env(thread_limit: Optional[str]) -> Dict[str, str]:
+    # the environment for one tesseract program - the limit is passed to each one instead
+    # of being set on our own environment, so it doesn't stick around for later files
+    env = dict(os.environ)
+    limit = thread_limit or _inherited_thread_limit
+    if limit:
+        env["OMP_THREAD_LIMIT"] = limit
+    else:
+        env.pop("OMP_THREAD_LIMIT", None)
+    return env
+
+
+def _limit_tesserocr_threads(thread_limit: Optional[str]) -> bool:
+    # libtesseract's OpenMP only reads OMP_THREAD_LIMIT from the environment, once, when
+    # the library loads - so for tesserocr this is the one place our own environment gets
+    # changed, right before it's first imported (see _get_tesserocr_api)
+    # returns False if tesserocr was already loaded with a different limit
+    if "tesserocr" in sys.modules:
+        return not thread_limit or os.environ.get("OMP_THREAD_LIMIT") == thread_limit
+    if thread_limit:
+        os.environ["OMP_THREAD_LIMIT"] = thread_limit
+    return True
+
+
+def _init_batch_worker(thread_limit: Optional[str]) -> None:
+    # runs at the start of every batch worker process - the files in it share the CPU with
+    # the other workers, so every tesseract it starts (or loads) gets the batch's limit
+    global _inherited_thread_limit
+    if thread_limit:
+        _inherited_thread_limit = thread_limit
+        os.environ["OMP_THREAD_LIMIT"] = thread_limit
+
+
+def _flush_merged(merged: fitz.Document, scratch_dir: str, flush_num: int) -> fitz.Document:
+    # save the pages collected so far and reopen the file - the reopened document only
+    # loads pages from disk when it needs them, so memory use stays flat however long
+    # the PDF is. Alternates between two files since the open one can't be overwritten.
+    partial_path = os.path.join(scratch_dir, f"partial_{flush_num % 2}.pdf")
+    merged.save(partial_path)
+    merged.close()
+    return fitz.open(partial_path)
+
+
+def _pool_context():
+    # on Linux, fork the batch workers so they start with everything already imported
+    # and set up instead of starting a fresh Python that imports it all again
+    # forking a process with other threads running can deadlock the child (the GUI runs
+    # us on a background thread), and fork is the default on Linux, so then start the
+    # workers fresh with spawn. Other systems already spawn by default.
+    if threading.active_count() > 1:
+        return multiprocessing.get_context("spawn")
+    if sys.platform.startswith("linux"):
+        return multiprocessing.get_context("fork")
+    return None
+
+
+def _is_terminal(stream) -> bool:
+    # stderr can be None (pythonw) or something that isn't a real file (the GUI log)
+    isatty = getattr(stream, "isatty", None)
+    return bool(isatty and isatty())
+
+
+def _default_output_path(input_path: str) -> str:
+    # if no output name given, just add "_searchable" to the original name
+    input_path = Path(input_path)
+    return str(input_path.parent / f"{input_path.stem}_searchable.pdf")
+
+
+def _process_one(input_path: str, output_path: Optional[str], input_stat: os.stat_result,
+                 options: Dict[str, Any]) -> Tuple[bool, str, str]:
+    # process a single file inside a batch worker process
+    # errors come back as (False, message) so one bad file doesn't kill the whole batch
+    # everything the file prints is collected and handed back too, so the main process can
+    # print it in one piece instead of it getting mixed up with the other workers' output
+    # (and so it reaches the GUI's log window, which worker processes can't write to)
+    log = io.StringIO()
+    with contextlib.redirect_stdout(log), contextlib.redirect_stderr(log):
+        try:
+            processor = PdfOcr(**options)
+            ok, result = True, processor.process_file(input_path, output_path, input_stat=input_stat)
+        except PdfOcrError as e:
+            ok, result = False, str(e)
+    return ok, result, log.getvalue()
+
+
 class PdfOcr:
-    def __init__(self, dpi: int = 300, language: str = "eng", optimize_size: bool = True):
+    def __init__(self, dpi: int = 300, language: str = "eng", optimize_size: bool = True,
+                 ocr_workers: Optional[int] = None, psm: int = 6, oem: int = 1,
+                 progress_callback: Optional[Callable[[int, int], None]] = None, engine: str = "auto",
+                 use_cache: bool = False, cache_dir: Optional[str] = None, aggressive_compress: bool = False,
+                 skip_text_pages: bool = True, image_quality: Optional[float] = None,
+                 omp_threads: Optional[int] = None):
         self.dpi = dpi
         self.language = language
         self.optimize_size = optimize_size
 
+        # tesseract layout/engine modes - psm 6 ("one uniform block of text") skips the
+        # orientation detection and layout analysis passes, which is a lot faster on
+        # ordinary scanned pages. oem 1 is the LSTM engine. Use psm 3 for complex layouts.
+        self.psm = psm
+        self.oem = oem
+
+        # called as progress_callback(done, total) - per page in process_file, and
+        # per file when process_batch spreads the files over several processes
+        self.progress_callback = progress_callback
+
+        # how many pages to OCR at the same time (None = one per CPU core), and how many
+        # threads each tesseract may use (None = 1 when OCRing several pages at once)
+        # keep ocr_workers * omp_threads at or below the number of cores
+        if ocr_workers is not None and ocr_workers < 1:
+            raise PdfOcrError(f"Number of OCR workers must be at least 1, got {ocr_workers}")
+        if omp_threads is not None and omp_threads < 1:
+            raise PdfOcrError(f"Number of tesseract threads must be at least 1, got {omp_threads}")
+        self.ocr_workers = ocr_workers
+        self.omp_threads = omp_threads
+
         # if optimizing, use lower DPI for OCR (200 is plenty for text recognition)
         # but keep original DPI for display quality
         self.ocr_dpi = min(dpi, 200) if optimize_size else dpi
 
+        # JPEG quality (0-1) of the page images in the output when optimizing - scans are
+        # nearly all image data, so this is what decides the file size
+        # (None = DEFAULT_IMAGE_QUALITY, and no warnings about it being ignored)
+        if image_quality is not None:
+            if not 0 < image_quality <= 1:
+                raise PdfOcrError(f"Image quality must be between 0 and 1, got {image_quality}")
+            if not optimize_size:
+                print("Warning: image quality only applies when optimizing, ignoring it")
+        self.image_quality = image_quality
+
+        # the zoom to render pages at that DPI (PyMuPDF uses 72 DPI by default, so we scale
+        # from there) - it never changes, so work it out once instead of for every file
+        zoom = self.ocr_dpi / 72.0
+        self._render_matrix = fitz.Matrix(zoom, zoom)
+
+        # OCR results can be remembered by page image, so repeated pages (forms, cover sheets,
+        # re-running the same file) skip tesseract entirely. Off unless asked for: every
+        # cached page is a copy of the scanned page, and scans are often private.
+        self.use_cache = use_cache
+        self.cache_dir = cache_dir or _default_cache_dir()
+
+        # the full garbage collection + cleanup pass when saving is slow and hardly shrinks
+        # a freshly built PDF, so it's only done when asked for
+        self.aggressive_compress = aggressive_compress
+
+        # pages that already have selectable text (cover pages, appendices from mixed documents)
+        # are copied over unchanged instead of being OCR'd again
+        self.skip_text_pages = skip_text_pages
+
+        # which OCR engine to use (see ENGINES at the top)
+        if engine not in ENGINES:
+            raise PdfOcrError(f"Unknown OCR engine '{engine}', choose from: {', '.join(ENGINES)}")
+        self.engine = engine
+
         # make sure we have the tools we need
-        verify_tesseract_installed()
+        # (with tesserocr the OCR runs in-process, so the tesseract program isn't needed)
         verify_pymupdf_installed()
+        if engine == "tesserocr" and not _tesserocr_available():
+            raise TesseractError("tesserocr is not installed. Please install it:\n  pip install tesserocr")
+        if engine == "pymupdf" and not _pymupdf_ocr_available():
+            raise TesseractError(
+                "PyMuPDF's built-in OCR is not available. It needs PyMuPDF 1.19 or newer and\n"
+                "tesseract's language data (set TESSDATA_PREFIX to the tessdata folder)"
+            )
+        # auto can fall back on PyMuPDF's OCR without the tesseract program, but checking for
+        # that is slow (it goes looking for the language data), so only when it's needed
+        if engine == "tesseract" or (
+            engine == "auto" and not _tesserocr_available() and not find_tesseract()
+            and not _pymupdf_ocr_available()
+        ):
+            verify_tesseract_installed()
+
+        # the tesseract built into PyMuPDF doesn't look at OMP_THREAD_LIMIT
+        if engine == "pymupdf" and omp_threads:
+            print("Warning: the number of tesseract threads can't be set with the pymupdf engine, ignoring it")
     
-    def process_file(self, input_path: str, output_path: Optional[str] = None) -> str:
+    def process_file(self, input_path: str, output_path: Optional[str] = None,
+                     input_stat: Optional[os.stat_result] = None) -> str:
         # check that the input file exists and is actually a PDF
-        verify_input_file(input_path)
-
-        input_path = Path(input_path)
+        # (skipped if the caller already checked it and passed in the stat result)
+        if input_stat is None:
+            input_stat = verify_input_file(input_path)
 
-        # if no output name given, just add "_searchable" to the original name
         if not output_path:
-            output_path = str(input_path.parent / f"{input_path.stem}_searchable.pdf")
+            output_path = _default_output_path(input_path)
+        input_path = Path(input_path)
 
         # make sure we can write to the output location
         verify_output_location(output_path)
@@ -53,36 +609,74 @@ class PdfOcr:
         print(f"Output will be saved to: {output_path}")
 
         try:
-            # use a temp folder for all the intermediate files
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # step 1: turn PDF pages into image files
-                print("Converting PDF to images...")
-                images = self._convert_pdf_to_images(str(input_path), temp_dir)
-
-                # step 2: run OCR on each image and make mini PDFs
-                print(f"Performing OCR on {len(images)} pages...")
-                pdf_writer = PdfWriter()
-
-                for i, image_path in enumerate(tqdm(images, desc="OCR Processing")):
-                    # OCR this page and save as a small PDF
-                    searchable_page_path = os.path.join(temp_dir, f"searchable_page_{i}.pdf")
-                    self._ocr_page(image_path, searchable_page_path)
-
-                    # add this page to our final PDF
-                    pdf_reader = PdfReader(searchable_page_path)
-                    if len(pdf_reader.pages) > 0:
-                        pdf_writer.append(pdf_reader)
-                    else:
+            try:
+                pdf_document = fitz.open(str(input_path))
+            except Exception as e:
+                raise PdfOcrError(f"Failed to open PDF: {str(e)}")
+
+            page_count = len(pdf_document)
+
+            # the searchable pages get collected into this new document
+            # (long documents get written out to a scratch file every so often, see _flush_merged)
+            merged = fitz.open()
+            scratch = None
+            if page_count > FLUSH_EVERY_PAGES:
+                # worst case the scratch copy is as big as the rendered pixels
+                channels = 1 if self.optimize_size else 3
+                size_estimate = input_stat.st_size * (self.ocr_dpi / 72.0) ** 2 * channels
+                scratch = tempfile.TemporaryDirectory(dir=_scratch_location(size_estimate))
+            try:
+                # render each page and OCR it straight from memory - no image files on disk
+                results = self._ocr_pages(pdf_document, page_count)
+
+                # the progress bar only makes sense in a real terminal (not the GUI log window),
+                # and doesn't need redrawing more than twice a second
+                progress = tqdm(results, total=page_count, desc="OCR Processing",
+                                mininterval=0.5, disable=not _is_terminal(sys.stderr))
+
+                skipped = 0
+                for i, page_pdf in enumerate(progress):
+                    # add this page to our final PDF (PyMuPDF does the copying in C)
+                    # no OCR result means the page already had text, so copy the original
+                    # anything this small can't hold a page, so don't bother parsing it
+                    if page_pdf is None:
+                        merged.insert_pdf(pdf_document, from_page=i, to_page=i)
+                        skipped += 1
+                        progress.set_postfix(skipped=skipped, refresh=False)
+                    elif len(page_pdf) < MIN_PDF_BYTES:
                         print(f"Warning: OCR produced empty page for page {i+1}")
+                    else:
+                        with fitz.open("pdf", page_pdf) as page_doc:
+                            if page_doc.page_count > 0:
+                                merged.insert_pdf(page_doc)
+                            else:
+                                print(f"Warning: OCR produced empty page for page {i+1}")
+
+                    if self.progress_callback:
+                        self.progress_callback(i + 1, page_count)
+
+                    if scratch and (i + 1) % FLUSH_EVERY_PAGES == 0 and i + 1 < page_count:
+                        merged = _flush_merged(merged, scratch.name, (i + 1) // FLUSH_EVERY_PAGES)
 
-                # step 3: save the combined PDF
-                with open(output_path, 'wb') as output_file:
-                    pdf_writer.write(output_file)
+                if skipped:
+                    print(f"Skipped OCR on {skipped} pages that already have text")
+                    if self.image_quality is not None:
+                        print("Warning: pages that already have text are copied unchanged, "
+                              "the image quality setting doesn't apply to them")
 
-                # step 4: compress it to make the file smaller
+                # save the combined PDF - when optimizing, compress it in the same write
+                # instead of saving it and then opening it again to compress it
                 if self.optimize_size:
-                    self._compress_pdf(output_path)
-            
+                    print("Compressing final PDF...")
+                    merged.save(output_path, **self._compress_options())
+                else:
+                    merged.save(output_path)
+            finally:
+                merged.close()
+                pdf_document.close()
+                if scratch:
+                    scratch.cleanup()
+
             print(f"Successfully created searchable PDF: {output_path}")
             return output_path
             
@@ -107,26 +701,88 @@ class PdfOcr:
             # Validate output directory
             verify_output_location(output_dir, is_directory=True)
         
-        output_paths = []
-        errors = []
-        
-        for input_path in input_paths:
+        results = [None] * len(input_paths)
+
+        # check each input once up front and work out where each file goes
+        # the stat result is passed along so process_file doesn't check it again
+        # two inputs writing the same output file at the same time would corrupt it
+        # (the same name from different folders into one output_dir, or the same file twice)
+        jobs = []
+        output_owners = {}
+        for index, input_path in enumerate(input_paths):
             try:
-                input_path = Path(input_path)
-                
-                if output_dir:
-                    output_path = os.path.join(output_dir, f"{input_path.stem}_searchable.pdf")
-                else:
-                    output_path = None  # Will use default naming in process_file
-                    
-                result_path = self.process_file(str(input_path), output_path)
-                output_paths.append(result_path)
-                
+                input_stat = verify_input_file(input_path)
             except PdfOcrError as e:
                 print(f"Error: {str(e)}")
-                errors.append(str(e))
+                results[index] = (False, str(e))
                 continue
-        
+
+            if output_dir:
+                output_path = os.path.join(output_dir, f"{Path(input_path).stem}_searchable.pdf")
+            else:
+                output_path = _default_output_path(input_path)
+
+            output_key = os.path.normcase(os.path.abspath(output_path))
+            if output_key in output_owners:
+                owner = output_owners[output_key]
+                if os.path.samefile(owner, input_path):
+                    error = f"{input_path} is listed more than once, skipping the repeat"
+                else:
+                    error = f"{input_path} would overwrite the output of {owner}: {output_path}"
+                print(f"Error: {error}")
+                results[index] = (False, error)
+                continue
+            output_owners[output_key] = input_path
+
+            jobs.append((index, str(input_path), output_path, input_stat))
+
+        # ocr_workers is the total for the whole batch, however it's split between files
+        total_workers = self.ocr_workers or os.cpu_count() or 1
+        file_workers = min(len(jobs), total_workers)
+
+        if file_workers <= 1:
+            # nothing to parallelize across files, let process_file use all the cores on pages
+            for index, input_path, output_path, input_stat in jobs:
+                try:
+                    results[index] = (True, self.process_file(input_path, output_path, input_stat=input_stat))
+                except PdfOcrError as e:
+                    print(f"Error: {str(e)}")
+                    results[index] = (False, str(e))
+        else:
+            # several files at once, each in its own process
+            # split the cores between files and pages so we don't start way more
+            # tesseract processes than there are cores
+            if len(jobs) >= total_workers:
+                ocr_workers = 1
+            else:
+                ocr_workers = max(1, total_workers // len(jobs))
+
+            # files running side by side share the cores, so each worker process limits its tesseracts
+            thread_limit = _thread_limit(file_workers, self.omp_threads)
+
+            with ProcessPoolExecutor(max_workers=file_workers, mp_context=_pool_context(),
+                                     initializer=_init_batch_worker, initargs=(thread_limit,)) as executor:
+                options = self._options(ocr_workers=ocr_workers)
+                tasks = (
+                    ((index, input_path), (input_path, output_path, input_stat, options))
+                    for index, input_path, output_path, input_stat in jobs
+                )
+                finished = _as_completed_bounded(executor, _process_one, tasks, limit=file_workers * 2)
+
+                for done, ((index, input_path), (ok, result, log)) in enumerate(finished, start=1):
+                    print(log, end="")
+                    results[index] = (ok, result)
+                    if self.progress_callback:
+                        self.progress_callback(done, len(jobs))
+                    if ok:
+                        print(f"[{done}/{len(jobs)}] Finished: {input_path}")
+                    else:
+                        print(f"[{done}/{len(jobs)}] Error: {result}")
+
+        # keep the results in the same order as the input files
+        output_paths = [result for ok, result in results if ok]
+        errors = [result for ok, result in results if not ok]
+
         # Summarize batch processing
         if output_paths:
             print(f"\nSuccessfully processed {len(output_paths)} out of {len(input_paths)} files")
@@ -138,86 +794,182 @@ class PdfOcr:
         
         return output_paths
 
-    def _convert_pdf_to_images(self, pdf_path: str, temp_dir: str) -> List[str]:
-        # turn each PDF page into a JPEG image file
-        image_paths = []
+    def _ocr_pages(self, pdf_document: fitz.Document, page_count: int) -> Iterator[Optional[bytes]]:
+        # OCR every page, handing back each page's searchable PDF in page order
+        # (None for pages that already have text, see _render_pages)
+        workers = max(1, min(page_count, self.ocr_workers or os.cpu_count() or 1))
+        engine = self._pick_engine()
+        print(f"Performing OCR on {page_count} pages (engine: {engine})...")
 
-        try:
-            pdf_document = fitz.open(pdf_path)
+        # PyMuPDF's OCR stores the page image losslessly, there's no JPEG quality to set
+        if engine == "pymupdf" and self.optimize_size and self.image_quality is not None:
+            print("Warning: image quality can't be set with the pymupdf engine, ignoring it")
 
-            # figure out the zoom level to get the DPI we want
-            # PyMuPDF uses 72 DPI by default, so we scale from there
-            zoom = self.ocr_dpi / 72.0
-            mat = fitz.Matrix(zoom, zoom)
+        cache_dir = self.cache_dir if self.use_cache else None
+        if cache_dir:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+            except OSError as e:
+                print(f"Warning: OCR cache disabled, cannot create {cache_dir}: {str(e)}")
+                cache_dir = None
 
-            for page_num in range(len(pdf_document)):
-                page = pdf_document[page_num]
+        thread_limit = _thread_limit(workers, self.omp_threads)
+        if engine == "tesserocr" and not _limit_tesserocr_threads(thread_limit) and self.omp_threads:
+            print("Warning: tesserocr is already loaded in this process with a different thread limit, "
+                  "the number of tesseract threads can't be changed now")
 
-                # render this page as an image
-                # alpha=False means no transparency, which makes files smaller
-                pix = page.get_pixmap(matrix=mat, alpha=False)
+        # (after the thread limit, looking up the version loads tesserocr)
+        version = _engine_version(engine) if cache_dir else ""
 
-                # convert to JPEG with decent quality (85% is good balance of size vs quality)
-                img_data = pix.tobytes("jpeg", jpg_quality=85)
+        if engine == "pymupdf":
+            key = ("pymupdf", version, self.language, self.ocr_dpi)
+            return (
+                _cached_ocr(
+                    cache_dir and _cache_path(
+                        cache_dir, self.language, key + (pix.width, pix.height, pix.n), pix.samples_mv
+                    ),
+                    lambda: _ocr_page_pymupdf(i, pix, self.language)
+                ) if pix is not None else None
+                for i, pix in self._render_pages(pdf_document)
+            )
 
-                # save the image file
-                image_path = os.path.join(temp_dir, f"page_{page_num}.jpg")
-                with open(image_path, 'wb') as f:
-                    f.write(img_data)
+        # PyMuPDF isn't thread-safe, so rendering (and getting the pixels out of the pixmap)
+        # stays on this thread - it overlaps with the OCR running in the worker threads,
+        # and everything after that (cache hashing, OCR) happens in the workers
+        settings = self._ocr_settings(engine, version)
+        if engine == "tesseract":
+            return self._ocr_with_tesseract(pdf_document, page_count, workers, settings, cache_dir, thread_limit)
 
-                image_paths.append(image_path)
+        tasks = (
+            (i, _pixmap_to_image(pix) if pix is not None else None, settings, cache_dir)
+            for i, pix in self._render_pages(pdf_document)
+        )
+        return _ocr_in_threads(_ocr_page_worker, tasks, workers)
 
-                # free up memory
-                pix = None
+    def _ocr_with_tesseract(self, pdf_document: fitz.Document, page_count: int, workers: int,
+                            settings: _OcrSettings, cache_dir: Optional[str],
+                            thread_limit: Optional[str]) -> Iterator[Optional[bytes]]:
+        # the tesseract program is given several pages per run, so it only loads the language
+        # model once for all of them - but short documents are still spread over every worker
+        pages_per_run = max(1, min(PAGES_PER_TESSERACT_RUN, -(-page_count // workers)))
 
-            pdf_document.close()
+        # the page images go in a scratch folder for tesseract to read (PNM: uncompressed, so
+        # it's quick to write and there's no lossy JPEG step before OCR). Only the runs being
+        # worked on or queued have files there, and each run deletes its own when it's done.
+        page_bytes = 0
+        if page_count:
+            rect = pdf_document[0].rect
+            page_bytes = rect.width * rect.height * (self.ocr_dpi / 72.0) ** 2 * (1 if self.optimize_size else 3)
+        size_estimate = page_bytes * pages_per_run * workers * 2
 
-        except Exception as e:
-            raise PdfOcrError(f"Failed to convert PDF to images: {str(e)}")
+        with tempfile.TemporaryDirectory(dir=_scratch_location(size_estimate)) as scratch_dir:
+            def tasks():
+                pages = []
+                for i, pix in self._render_pages(pdf_document):
+                    image_path = None
+                    if pix is not None:
+                        image_path = os.path.join(scratch_dir, f"page_{i}.pnm")
+                        pix.save(image_path)
+                    pages.append((i, image_path))
 
-        return image_paths
+                    if len(pages) == pages_per_run:
+                        yield pages, settings, cache_dir, thread_limit, scratch_dir
+                        pages = []
+                if pages:
+                    yield pages, settings, cache_dir, thread_limit, scratch_dir
 
-    def _ocr_page(self, image_path: str, output_path: str) -> None:
-        # take an image and turn it into a searchable PDF page
-        try:
-            # tesseract config - if we're optimizing, use settings that make smaller files
-            if self.optimize_size:
-                config = '-c tessedit_create_pdf=1 -c textonly_pdf=0'
-            else:
-                config = ''
-
-            # this is where the magic happens - tesseract reads the image and makes a PDF
-            pdf_data = pytesseract.image_to_pdf_or_hocr(
-                image_path,
-                extension='pdf',
-                lang=self.language,
-                config=config
-            )
+            yield from _split_chunks(_ocr_in_threads(_ocr_chunk_worker, tasks(), workers))
 
-            # save the PDF data to a file
-            with open(output_path, 'wb') as f:
-                f.write(pdf_data)
+    def _pick_engine(self) -> str:
+        if self.engine != "auto":
+            return self.engine
 
-        except Exception as e:
-            raise TesseractError(f"OCR processing failed: {str(e)}")
+        # tesserocr is the fastest: in-process and works from several threads
+        if _tesserocr_available():
+            return "tesserocr"
+
+        # PyMuPDF's OCR ignores psm/oem and the JPEG quality and stores page images
+        # differently, so it's only the last resort - otherwise the output would depend
+        # on which engine happened to get picked
+        if find_tesseract() or not _pymupdf_ocr_available():
+            return "tesseract"
+        return "pymupdf"
 
-    def _compress_pdf(self, pdf_path: str) -> None:
-        # squeeze the final PDF to make it smaller
+    def _render_pages(self, pdf_document: fitz.Document) -> Iterator[Tuple[int, Optional[fitz.Pixmap]]]:
+        # turn each PDF page into an in-memory image, one page at a time
+        # pages that already have a text layer aren't rendered at all (the pixmap is None)
         try:
-            print("Compressing final PDF...")
+            # tesseract works in grayscale anyway, so when optimizing render 1 byte per pixel
+            # instead of 3 (the page image in the output PDF ends up grayscale too)
+            colorspace = fitz.csGRAY if self.optimize_size else fitz.csRGB
+
+            for page_num, page in enumerate(pdf_document):
+                if self.skip_text_pages and len(page.get_text("text").strip()) > MIN_TEXT_CHARS:
+                    yield page_num, None
+                    continue
 
-            doc = fitz.open(pdf_path)
+                # render this page as an image
+                # alpha=False means no transparency, which makes files smaller
+                pix = page.get_pixmap(matrix=self._render_matrix, colorspace=colorspace, alpha=False)
 
-            # these settings compress the PDF and remove junk
-            # deflate=1: zip compression
-            # garbage=4: remove unused stuff
-            # clean=1: tidy up the file structure
-            doc.save(pdf_path, deflate=1, garbage=4, clean=1)
-            doc.close()
+                # PyMuPDF's OCR sizes the page from the pixmap's resolution, so keep the
+                # OCR'd page the same size as the original
+                pix.set_dpi(self.ocr_dpi, self.ocr_dpi)
+                yield page_num, pix
 
         except Exception as e:
-            # if compression fails, don't crash the whole thing
-            print(f"Warning: PDF compression failed: {str(e)}")
+            raise PdfOcrError(f"Failed to convert PDF to images: {str(e)}")
+
+    def _options(self, **overrides) -> Dict[str, Any]:
+        # the constructor arguments, so worker processes can build an identical PdfOcr
+        options = dict(
+            dpi=self.dpi,
+            language=self.language,
+            optimize_size=self.optimize_size,
+            ocr_workers=self.ocr_workers,
+            psm=self.psm,
+            oem=self.oem,
+            engine=self.engine,
+            use_cache=self.use_cache,
+            cache_dir=self.cache_dir,
+            aggressive_compress=self.aggressive_compress,
+            skip_text_pages=self.skip_text_pages,
+            image_quality=self.image_quality,
+            omp_threads=self.omp_threads,
+        )
+        options.update(overrides)
+        return options
+
+    def _ocr_settings(self, engine: str, version: str = "") -> _OcrSettings:
+        # tesseract settings - we always want a PDF with the page image in it
+        # thresholding_method=1 is Otsu thresholding from Leptonica (ignored by tesseract 4)
+        # the page images we hand over carry no resolution, so tell tesseract what it is -
+        # otherwise it guesses 70 dpi and the OCR'd pages come out far bigger than the originals
+        variables = (
+            ("tessedit_create_pdf", "1"),
+            ("textonly_pdf", "0"),
+            ("thresholding_method", "1"),
+            ("user_defined_dpi", str(self.ocr_dpi)),
+        )
+
+        # tesseract stores the page image in the PDF as a JPEG (quality 85 by default)
+        # when optimizing, set the quality here so the image is only encoded once -
+        # recompressing it after the PDF is built would cost a decode and a second lossy pass
+        if self.optimize_size:
+            image_quality = self.image_quality or DEFAULT_IMAGE_QUALITY
+            variables += (("jpg_quality", str(round(image_quality * 100))),)
+
+        return _OcrSettings(engine, self.language, self.psm, self.oem, variables, version)
+
+    def _compress_options(self) -> Dict[str, int]:
+        # save() settings that compress the PDF and remove junk
+        # deflate: zip compression (for images and fonts too)
+        # garbage=1: remove unused stuff (4 also merges duplicates, which is much slower and
+        #            finds next to nothing in a PDF we just built)
+        # clean=1: tidy up the file structure (only with aggressive_compress)
+        if self.aggressive_compress:
+            return dict(deflate=1, deflate_images=1, deflate_fonts=1, garbage=4, clean=1)
+        return dict(deflate=1, deflate_images=1, deflate_fonts=1, garbage=1, clean=0)
 
 
 def main():
@@ -227,11 +979,33 @@ def main():
     parser.add_argument("-d", "--dpi", type=int, default=300, help="DPI resolution for conversion (default: 300)")
     parser.add_argument("-l", "--lang", default="eng", help="OCR language (default: eng)")
     parser.add_argument("--no-optimize", action="store_true", help="Disable file size optimization")
+    parser.add_argument("--psm", type=int, default=6,
+                        help="Tesseract page segmentation mode (default: 6, use 3 for complex layouts)")
+    parser.add_argument("--oem", type=int, default=1, help="Tesseract OCR engine mode (default: 1 = LSTM)")
+    parser.add_argument("--image-quality", type=float,
+                        help="JPEG quality of the page images when optimizing, 0-1 (default: 0.75)")
+    parser.add_argument("--aggressive-compress", action="store_true",
+                        help="Run the slower, more thorough PDF cleanup when saving")
+    parser.add_argument("--cache", action="store_true",
+                        help="Reuse and store OCR results in a cache (keeps a copy of every page on disk)")
+    parser.add_argument("--force-ocr", action="store_true",
+                        help="OCR every page, even pages that already have selectable text")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="How many pages (or files) to OCR at the same time (default: one per CPU core)")
+    parser.add_argument("--omp-threads", type=int,
+                        help="Threads each Tesseract may use (default: 1 when running several jobs). "
+                             "Keep jobs x omp-threads at or below the number of CPU cores")
+    parser.add_argument("--engine", choices=ENGINES, default="auto",
+                        help="How to run Tesseract (default: auto picks the fastest available)")
 
     args = parser.parse_args()
 
     try:
-        processor = PdfOcr(dpi=args.dpi, language=args.lang, optimize_size=not args.no_optimize)
+        processor = PdfOcr(dpi=args.dpi, language=args.lang, optimize_size=not args.no_optimize,
+                           psm=args.psm, oem=args.oem, engine=args.engine, use_cache=args.cache,
+                           aggressive_compress=args.aggressive_compress, skip_text_pages=not args.force_ocr,
+                           image_quality=args.image_quality, ocr_workers=args.jobs,
+                           omp_threads=args.omp_threads)
         
         if len(args.input) == 1:
             # Process a single file